@@ -1,5 +1,6 @@
 import streamlit as st
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 st.set_page_config(page_title="تشغيل سكربتات متعددة", page_icon="⚙️", layout="centered")
 
@@ -45,10 +46,20 @@ if st.button("▶️ تشغيل المحدد"):
                 st.success("✅ تم تشغيل جميع السكربتات بالتتابع!")
 
             else:
-                # تشغيل كلهم في وقت واحد
-                processes = []
-                for script in selected_scripts:
-                    st.write(f"🚀 تشغيل {script} في الخلفية...")
-                    p = subprocess.Popen(["python", script])
-                    processes.append(p)
+                # تشغيل كلهم في وقت واحد مع التقاط المخرجات عند انتهاء كل سكربت
+                st.info("⏳ سيتم انتظار انتهاء جميع السكربتات، وتظهر مخرجات كل سكربت عند انتهائه")
+                with ThreadPoolExecutor(max_workers=len(selected_scripts)) as executor:
+                    futures = {}
+                    for script in selected_scripts:
+                        st.write(f"🚀 تشغيل {script} بالتوازي...")
+                        future = executor.submit(
+                            subprocess.run, ["python", script], capture_output=True, text=True
+                        )
+                        futures[future] = script
+
+                    for future in as_completed(futures):
+                        script = futures[future]
+                        result = future.result()
+                        st.write(f"🔸 انتهى {script}")
+                        st.text(result.stdout)
                 st.success("✅ تم تشغيل جميع السكربتات بالتوازي!")
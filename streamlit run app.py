@@ -1,13 +1,17 @@
 import pandas as pd
-from pathlib import Path
-from collections import defaultdict
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
 from functools import lru_cache
+import importlib.util
 import streamlit as st
 import io
+import tempfile
+import threading
+import sys
 import datetime
-from io import BytesIO
-import calendar
 import plotly.express as px
+import xlsxwriter
 
 # Configure the page
 st.set_page_config(page_title="MRP_Calculator Raw Material Requirements ", page_icon="📊", layout="wide")
@@ -16,9 +20,132 @@ st.set_page_config(page_title="MRP_Calculator Raw Material Requirements ", page_
 st.title("📊MRP_Calculator Raw Material Requirements (MRP)")
 st.markdown("---")
 
+# وحدات الجرام التي تحول إلى كيلوجرام
+GRAM_UOMS = frozenset({'G', 'GR', 'GRAM', 'GRAMS'})
+
+# نوع المادة حسب الرقم الأول من الكود
+MATERIAL_TYPES = {'5': 'منتج تام', '4': 'منتج مصنع', '1': 'مادة خام'}
+# مستوى المادة حسب نوعها (المنتج المصنع الذي له أبناء يصبح مستوى 2)
+MATERIAL_LEVELS = {'منتج تام': 1, 'منتج مصنع': 3, 'مادة خام': 4}
+
+# قالب صف جدول الملخص الشهري (اللون، الشهر، E، L، الإجمالي، E%، L%)
+SUMMARY_ROW_HTML = (
+    "<tr style='background-color:{};'><td style='color:blue;'>{}</td>"
+    "<td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>"
+)
+
+# محرك قراءة Excel: calamine أسرع بكثير من openpyxl إذا كان مثبتاً
+EXCEL_ENGINE = "calamine" if importlib.util.find_spec("python_calamine") is not None else "openpyxl"
+
+
+def _parse_workbook(file_bytes: bytes) -> dict:
+    """قراءة شيتات الملف - تستدعى مرة واحدة لكل محتوى ملف عبر get_calculator المحفوظة (بدون نسخة ثانية في الكاش)"""
+    # المحرك يحدد لملفات xlsx فقط (ملف zip يبدأ بـ PK)، وملفات xls القديمة يختار pandas محركها تلقائياً
+    engine = EXCEL_ENGINE if file_bytes[:2] == b"PK" else None
+    sheets = {}
+    with pd.ExcelFile(io.BytesIO(file_bytes), engine=engine) as excel_file:
+        # الشيتات تقرأ كاملة: BOM و MRP Contor تكتب كما هي في ملف النتائج (الحساب يبحث عن أعمدته بالاسم)
+        for sheet in ["Plan", "BOM", "MRP Contor"]:
+            if sheet in excel_file.sheet_names:
+                sheets[sheet] = pd.read_excel(excel_file, sheet_name=sheet)
+    return sheets
+
+
+def _to_float(text: str) -> float:
+    """float(text) والنص غير الصالح يصبح NaN"""
+    try:
+        return float(text)
+    except ValueError:
+        return np.nan
+
+
+def _to_number(values: pd.Series) -> pd.Series:
+    """مكافئ float(str(x).replace(",", ".")) لكل خلية، والقيم غير الصالحة تصبح NaN"""
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        return values.astype(float)
+    text = values.astype(str).str.replace(",", ".", regex=False)
+    numbers = pd.to_numeric(text, errors='coerce').astype(float)
+    # ما يرفضه to_numeric يعاد بـ float() الذي يقبل الأرقام العربية "٣" والأرقام العريضة و "1_000"
+    failed = numbers.isna().to_numpy() & values.notna().to_numpy()
+    if failed.any():
+        numbers[failed] = [_to_float(t) for t in text[failed]]
+    return numbers
+
+
+def _clean_str(values: pd.Series) -> pd.Series:
+    """مكافئ str(x).strip() لكل خلية في العمود (القيم الفارغة تصبح 'nan')"""
+    return values.astype(str).str.strip().fillna('nan')
+
+
+def _clean_factorized(value_ids: np.ndarray, uniques) -> pd.Categorical:
+    """نتيجة _clean_str كـ category من ناتج pd.factorize (التنظيف على القيم الفريدة فقط)"""
+    clean_ids, categories = pd.factorize(_clean_str(pd.Series(uniques)))
+    return pd.Categorical.from_codes(clean_ids[value_ids], categories)
+
+
+def _clean_codes(values: pd.Series) -> pd.Series:
+    """_clean_str لعمود قيمه متكررة: التنظيف يتم على القيم الفريدة فقط والنتيجة category"""
+    value_ids, uniques = pd.factorize(values, use_na_sentinel=False)
+    return pd.Series(_clean_factorized(value_ids, uniques), index=values.index)
+
+
+def _deduplicated(values) -> list:
+    """قائمة قيم نصية (أوصاف، وحدات، MRP Contor) تتكرر فيها القيمة الواحدة ككائن نص واحد مشترك"""
+    categorical = pd.Categorical(values)
+    categories = np.array([str(c) for c in categorical.categories], dtype=object)
+    return categories[categorical.codes].tolist()
+
+
+def _interned(codes) -> list:
+    """قائمة أكواد مواد (مفاتيح القواميس) يكون فيها كل كود كائناً واحداً مشتركاً (sys.intern) في جميع القواميس"""
+    categorical = pd.Categorical(codes)
+    categories = np.array([sys.intern(str(c)) for c in categorical.categories], dtype=object)
+    return categories[categorical.codes].tolist()
+
+
+@lru_cache(maxsize=256)
+def _find_column(columns: tuple, *names):
+    """أول عمود يطابق أحد الأسماء (بدون حساسية لحالة الأحرف) - النتيجة محفوظة لكل عناوين شيت"""
+    cols_lower = {str(c).lower(): c for c in columns}
+    for n in names:
+        if n.lower() in cols_lower:
+            return cols_lower[n.lower()]
+    return None
+
+
+def _write_sheet(workbook, sheet_name: str, frame: pd.DataFrame):
+    """كتابة DataFrame في شيت صفاً بصف (كما يتطلب وضع constant_memory) مع تثبيت صف العناوين"""
+    worksheet = workbook.add_worksheet(sheet_name)
+    worksheet.freeze_panes(1, 0)
+    worksheet.write_row(0, 0, frame.columns.tolist())
+    # الصفوف تقرأ من الجدول مباشرة بدون نسخة object كاملة منه، والقيم الفارغة (NaN/NaT/NA) تكتب كخلايا فارغة
+    # (مثل na_rep='' في to_excel) - القيمة الفارغة هي الوحيدة التي لا تساوي نفسها
+    for row, values in enumerate(frame.itertuples(index=False, name=None), start=1):
+        worksheet.write_row(row, 0, [None if value is pd.NA or value != value else value for value in values])
+
+
+def _set_calculated(calculated: bool):
+    """حفظ حالة عرض النتائج للجلسة: تفعل بزر الحساب وتلغى عند تغيير الملف المرفوع"""
+    st.session_state["mrp_calculated"] = calculated
+
+
+def _show_page(frame: pd.DataFrame, key: str, page_size: int = 100):
+    """عرض الجدول صفحة بصفحة: يرسل للمتصفح صفوف الصفحة المختارة فقط بدل الجدول كاملاً في كل إعادة تشغيل"""
+    pages = -(-len(frame) // page_size)
+    if pages <= 1:
+        st.dataframe(frame, use_container_width=True)
+        return
+    page = st.number_input(
+        f"📄 الصفحة (من {pages})", min_value=1, max_value=pages, value=1, step=1, key=key
+    )
+    start = (page - 1) * page_size
+    st.dataframe(frame.iloc[start:start + page_size], use_container_width=True)
+    st.caption(f"الصفوف {start + 1:,} - {min(start + page_size, len(frame)):,} من {len(frame):,} (الجدول كاملاً في ملف Excel)")
+
+
 class MRPCalculator:
     def __init__(self):
-        self.relations = defaultdict(list)
+        self.relations = {}  # المادة الأب -> (مصفوفة أكواد المكونات، مصفوفة الكميات)
         self.plan_df = None
         self.bom_df = None
         self.mrp_control_df = None
@@ -27,32 +154,64 @@ class MRPCalculator:
         self.standardized_uoms = {}  # تخزين الوحدات الموحدة
         self.mrp_control_values = {}  # تخزين قيم MRP Contor
         self.manufacturing_quantities = {}  # كميات التصنيع للمكونات الوسيطة
+        self._exploded = sparse.csr_matrix((0, 0))  # رقم المادة × رقم المادة النهائية = الكمية لكل وحدة (نتيجة التفجير)
+        self._leaf_ids = {}  # كود المادة النهائية (خام أو بدون مكونات) -> رقمها
+        self._leaf_codes = []  # رقم المادة النهائية -> كودها
+        self._material_ids = {}  # كود المادة في الـ BOM -> رقمها (الآباء أولاً بترتيب relations ثم باقي المكونات)
+        self._material_codes = []  # رقم المادة -> كودها
+        # روابط الـ BOM بصيغة CSR: مكونات الأب p هي المواقع من _child_ptr[p] إلى _child_ptr[p + 1]
+        self._child_ptr = np.zeros(1, dtype=np.int64)
+        self._child_ids = np.zeros(0, dtype=np.int64)  # رقم المكون لكل رابط
+        self._child_qtys = np.zeros(0)  # كمية المكون لكل رابط
+        self._expandable = np.zeros(0, dtype=bool)  # رقم الأب -> هل يتم تفجيره (ليس خام) - غيره يعامل كمادة خام
+        self._cut_edges = np.zeros(0, dtype=bool)  # قناع الروابط التي تغلق علاقة دائرية (المكون يعامل كمادة خام عند التفجير)
+        self._bom_adjacency = None  # مصفوفة متفرقة: الأب × المكون = الكمية (بدون الروابط الدائرية)
+        self._plan_matrices = {}  # أعمدة الشهور -> مصفوفة كميات الخطة (تحول لأرقام مرة واحدة)
+        self._plan_materials = None  # (أكواد مواد الخطة المنظفة، قناع الصفوف الصالحة) - تحسب مرة واحدة
+        self._material_types = {}  # كود المادة -> نوعها (يحسب مرة واحدة لكل كود)
+        self._material_levels = {}  # كود المادة -> مستواها (يحسب لجميع مواد الـ BOM عند ترقيمها)
+        self._all_levels_df = None  # نتيجة calculate_all_levels_requirements (تحسب مرة واحدة لكل BOM وخطة)
+        self._requirements_df = None  # نتيجة calculate_requirements (الحاسبة محفوظة عبر إعادة التشغيل فلا تعاد عند كل ضغطة)
+        self._raw_materials_df = None  # نتيجة generate_raw_materials_sheet
+        self._monthly_summary = None  # نتيجة create_monthly_summary (تعتمد على الخطة فقط)
+        self._manufacturing_df = None  # صفوف manufacturing_quantities بأعمدة شيت Manufacturing_Quantities
+        self._monthly_chart = None  # رسم create_monthly_chart (يعتمد على الملخص الشهري فقط)
+        # الحاسبة محفوظة بـ st.cache_resource ومشتركة بين الجلسات، والنتائج أعلاه تحسب عند أول طلب:
+        # الجلسات التي تعرض نفس الملف تمر على show_analysis واحدة تلو الأخرى
+        self._lock = threading.RLock()
         
+    def session(self):
+        """قفل الحاسبة المشتركة: with calculator.session() أثناء عرض النتائج وحسابها لجلسة واحدة"""
+        return self._lock
+
     def get_material_type(self, material_code):
         """تحديد نوع المادة بناءً على الرقم الأول"""
-        material_str = str(material_code).strip()
-        if not material_str or material_str == 'nan':
-            return 'غير معروف'
-        
-        first_char = material_str[0]
-        if first_char == '5':
-            return 'منتج تام'
-        elif first_char == '4':
-            return 'منتج مصنع'
-        elif first_char == '1':
-            return 'مادة خام'
-        else:
-            return 'غير معروف'
+        material_type = self._material_types.get(material_code)
+        if material_type is None:
+            material_str = str(material_code).strip()
+            if not material_str or material_str == 'nan':
+                material_type = 'غير معروف'
+            else:
+                material_type = MATERIAL_TYPES.get(material_str[0], 'غير معروف')
+            self._material_types[material_code] = material_type
+        return material_type
     
     def get_material_level(self, material_code):
         """تحديد مستوى المادة بناءً على نوعها وعلاقات الـ BOM"""
+        level = self._material_levels.get(material_code)
+        if level is None:
+            level = self._material_levels[material_code] = self._material_level(material_code)
+        return level
+    
+    def _material_level(self, material_code):
+        """حساب المستوى بدون الكاش"""
         material_type = self.get_material_type(material_code)
         
         if material_type == 'منتج تام':
             return 1
         elif material_type == 'منتج مصنع':
             # إذا كان المنتج المصنع له أبناء، فهو مستوى وسيط
-            if material_code in self.relations and self.relations[material_code]:
+            if material_code in self.relations:
                 return 2
             else:
                 return 3  # منتج مصنع نهائي
@@ -61,6 +220,27 @@ class MRPCalculator:
         else:
             return 999
     
+    def material_attributes(self, material_codes: list) -> pd.DataFrame:
+        """الوصف والنوع والمستوى والوحدة الموحدة و MRP Contor لقائمة مواد دفعة واحدة (الأكواد منظفة)"""
+        # ترجمة الأكواد لصفاتها مرة واحدة في نهاية الحساب عبر dict.get مباشرة
+        # (Series.map بقاموس يبني Series من القاموس كله في كل استدعاء)
+        material_types = [MATERIAL_TYPES.get(code[:1], 'غير معروف') for code in material_codes]
+        # مستويات مواد الـ BOM محسوبة مسبقاً، وغيرها ليس له أبناء فمستواه حسب نوعه فقط
+        levels = [
+            self._material_levels.get(code, MATERIAL_LEVELS.get(material_type, 999))
+            for code, material_type in zip(material_codes, material_types)
+        ]
+        descriptions, uoms, mrp_values = self.material_descriptions, self.material_uoms, self.mrp_control_values
+        standardized_uoms = self.standardized_uoms
+        # النوع والوحدة و MRP Contor قيم قليلة متكررة: category ترسل للمتصفح (Arrow) جدول قيم واحد وأرقاماً لكل صف
+        return pd.DataFrame({
+            'Material_Description': np.array([descriptions.get(code, '') for code in material_codes], dtype=object),
+            'Material_Type': pd.Categorical(material_types),
+            'Level': np.array(levels, dtype=np.int64),
+            'UoM': pd.Categorical([standardized_uoms.get(code, uoms.get(code, '')) for code in material_codes]),
+            'MRP_Contor': pd.Categorical([mrp_values.get(code, '') for code in material_codes]),
+        })
+
     def is_raw_material(self, material_code):
         """تحديد إذا كانت المادة مادة خام"""
         return self.get_material_type(material_code) == 'مادة خام'
@@ -76,23 +256,23 @@ class MRPCalculator:
     def load_data(self, uploaded_file) -> bool:
         """Load Plan, BOM and MRP Control sheets from uploaded Excel file"""
         try:
-            # Read Excel file
-            excel_file = pd.ExcelFile(uploaded_file)
+            # Read Excel file (once per file content, via the cached get_calculator)
+            sheets = _parse_workbook(uploaded_file.getvalue())
             
             # Check if required sheets exist
             required_sheets = ["Plan", "BOM"]
-            missing_sheets = [sheet for sheet in required_sheets if sheet not in excel_file.sheet_names]
+            missing_sheets = [sheet for sheet in required_sheets if sheet not in sheets]
             
             if missing_sheets:
                 st.error(f"❌ الشيتات التالية غير موجودة في الملف: {', '.join(missing_sheets)}")
                 return False
             
-            self.plan_df = pd.read_excel(excel_file, sheet_name="Plan")
-            self.bom_df = pd.read_excel(excel_file, sheet_name="BOM")
+            self.plan_df = sheets["Plan"]
+            self.bom_df = sheets["BOM"]
             
             # تحميل شيت MRP Contor إذا كان موجوداً (اختياري)
-            if "MRP Contor" in excel_file.sheet_names:
-                self.mrp_control_df = pd.read_excel(excel_file, sheet_name="MRP Contor")
+            if "MRP Contor" in sheets:
+                self.mrp_control_df = sheets["MRP Contor"]
                 st.success("✅ تم تحميل البيانات بنجاح (بما في ذلك MRP Contor)")
             else:
                 st.success("✅ تم تحميل البيانات بنجاح (بدون MRP Contor)")
@@ -114,17 +294,11 @@ class MRPCalculator:
             self.mrp_control_df.columns = [str(c).strip() for c in self.mrp_control_df.columns]
             
             # البحث عن أعمدة MRP Contor
-            cols_lower = {str(c).lower(): c for c in self.mrp_control_df.columns}
-            
-            def find_col(*names):
-                for n in names:
-                    if n.lower() in cols_lower:
-                        return cols_lower[n.lower()]
-                return None
+            columns = tuple(self.mrp_control_df.columns)
 
-            col_material = find_col("material", "code", "component", "item code", "raw_material")
-            col_description = find_col("description", "material description", "item description", "component_description")
-            col_mrp_control = find_col("mrp contor", "mrp control", "mrp", "control", "controller")
+            col_material = _find_column(columns, "material", "code", "component", "item code", "raw_material")
+            col_description = _find_column(columns, "description", "material description", "item description", "component_description")
+            col_mrp_control = _find_column(columns, "mrp contor", "mrp control", "mrp", "control", "controller")
             
             if not col_material:
                 st.warning("⚠️ عمود الأكواد غير موجود في شيت MRP Contor - سيتم تجاهل الشيت")
@@ -134,23 +308,25 @@ class MRPCalculator:
                 st.warning("⚠️ عمود MRP Contor غير موجود في شيت MRP Contor - سيتم تجاهل الشيت")
                 return True
             
-            # بناء قاموس قيم MRP Contor
-            mrp_control_count = 0
-            for _, row in self.mrp_control_df.iterrows():
-                material_code = str(row[col_material]).strip()
-                if material_code and material_code != 'nan' and material_code != '':
-                    # تخزين قيمة MRP Contor
-                    mrp_control_value = row[col_mrp_control]
-                    if pd.notna(mrp_control_value):
-                        self.mrp_control_values[material_code] = str(mrp_control_value).strip()
-                        mrp_control_count += 1
-                    
-                    # أيضا تخزين الوصف إذا كان متوفرا
-                    if col_description and pd.notna(row[col_description]):
-                        description = str(row[col_description]).strip()
-                        if description and description != '':
-                            # الأولوية لأوصاف MRP Contor
-                            self.material_descriptions[material_code] = description
+            # بناء قاموس قيم MRP Contor (آخر قيمة للكود هي المعتمدة)
+            material_codes = _clean_str(self.mrp_control_df[col_material])
+            valid_codes = material_codes.ne('') & material_codes.ne('nan')
+            
+            # تخزين قيمة MRP Contor
+            has_value = valid_codes & self.mrp_control_df[col_mrp_control].notna()
+            mrp_control_values = _clean_str(self.mrp_control_df[col_mrp_control])
+            self.mrp_control_values.update(
+                zip(_interned(material_codes[has_value]), _deduplicated(mrp_control_values[has_value]))
+            )
+            mrp_control_count = int(has_value.sum())
+            
+            # أيضا تخزين الوصف إذا كان متوفرا (الأولوية لأوصاف MRP Contor)
+            if col_description:
+                descriptions = _clean_str(self.mrp_control_df[col_description])
+                has_description = valid_codes & self.mrp_control_df[col_description].notna() & descriptions.ne('')
+                self.material_descriptions.update(
+                    zip(_interned(material_codes[has_description]), _deduplicated(descriptions[has_description]))
+                )
             
             st.info(f"✅ تم تحميل {mrp_control_count} قيمة MRP Contor")
             return True
@@ -166,19 +342,13 @@ class MRPCalculator:
     def prepare_bom_columns(self) -> tuple:
         """Identify and validate BOM columns"""
         self.bom_df.columns = [str(c).strip() for c in self.bom_df.columns]
-        cols_lower = {str(c).lower(): c for c in self.bom_df.columns}
-        
-        def find_col(*names):
-            for n in names:
-                if n.lower() in cols_lower:
-                    return cols_lower[n.lower()]
-            return None
+        columns = tuple(self.bom_df.columns)
 
-        col_parent = find_col("parent material", "parent", "parent code")
-        col_component = find_col("component", "component material", "child")
-        col_qty = find_col("component quantity", "component_quantity", "qty", "quantity")
-        col_component_description = find_col("component description", "comp description", "component desc")
-        col_uom = find_col("component uom", "uom", "unit of measure", "unit")
+        col_parent = _find_column(columns, "parent material", "parent", "parent code")
+        col_component = _find_column(columns, "component", "component material", "child")
+        col_qty = _find_column(columns, "component quantity", "component_quantity", "qty", "quantity")
+        col_component_description = _find_column(columns, "component description", "comp description", "component desc")
+        col_uom = _find_column(columns, "component uom", "uom", "unit of measure", "unit")
         
         missing_cols = []
         if not col_parent: missing_cols.append("Parent Material")
@@ -192,41 +362,42 @@ class MRPCalculator:
         st.info(f"✅ تم تحديد الأعمدة: Parent={col_parent}, Component={col_component}, Qty={col_qty}, Component Description={col_component_description}, UoM={col_uom}")
         return col_parent, col_component, col_qty, col_component_description, col_uom
 
-    def clean_bom_data(self, col_parent: str, col_component: str, col_qty: str, col_uom: str):
-        """تنظيف بيانات BOM وإزالة التكرار"""
+    def clean_bom_data(self, col_parent: str, col_component: str, col_qty: str, col_uom: str) -> tuple:
+        """تنظيف بيانات BOM وإزالة التكرار - يرجع أكواد الأب والمكون منظفة (category) لصفوف BOM الناتجة"""
         initial_rows = len(self.bom_df)
         
-        # 1. إزالة الصفوف الفارغة تماماً
-        self.bom_df = self.bom_df.dropna(how='all')
+        # عمودا الأب والمكون يحولان لأرقام مرة واحدة تستخدم للفلترة وإزالة التكرار وتنظيف الأكواد
+        parent_ids, parent_values = pd.factorize(self.bom_df[col_parent])
+        component_ids, component_values = pd.factorize(self.bom_df[col_component])
         
-        # 2. إزالة الصفوف التي تفتقد بيانات أساسية
-        essential_cols = [col_parent, col_component, col_qty]
-        self.bom_df = self.bom_df.dropna(subset=essential_cols)
+        # 1. الصفوف التي تحتوي على البيانات الأساسية (يشمل استبعاد الصفوف الفارغة تماماً)
+        keep_mask = (parent_ids >= 0) & (component_ids >= 0) & self.bom_df[col_qty].notna().to_numpy()
         
-        # 3. إزالة التكرار الكامل (نفس Parent + Component + Qty + UoM)
-        self.bom_df = self.bom_df.drop_duplicates(
-            subset=[col_parent, col_component, col_qty, col_uom], 
-            keep='first'
-        )
+        # 2. إزالة التكرار (نفس Parent + Component) - نأخذ آخر تحديث
+        #    يشمل ذلك التكرار الكامل (نفس Qty + UoM) فلا حاجة لمرور منفصل له
+        keys = parent_ids[keep_mask].astype(np.int64) * len(component_values) + component_ids[keep_mask]
+        keep_mask[keep_mask] = ~pd.Index(keys).duplicated(keep='last')
         
-        # 4. إزالة التكرار الجزئي (نفس Parent + Component) - نأخذ آخر تحديث
-        self.bom_df = self.bom_df.drop_duplicates(
-            subset=[col_parent, col_component], 
-            keep='last'
-        )
+        # نسخة واحدة فقط من البيانات بعد تطبيق القناع
+        self.bom_df = self.bom_df.loc[keep_mask].reset_index(drop=True)
         
         final_rows = len(self.bom_df)
         removed_rows = initial_rows - final_rows
         
         if removed_rows > 0:
             st.info(f"🧹 تم تنظيف بيانات BOM: إزالة {removed_rows} صف (من {initial_rows} إلى {final_rows})")
+        
+        return (
+            pd.Series(_clean_factorized(parent_ids[keep_mask], parent_values)),
+            pd.Series(_clean_factorized(component_ids[keep_mask], component_values)),
+        )
 
     def convert_quantity(self, quantity: float, uom: str) -> tuple:
         """Convert quantity from G to KG only and return standardized UoM"""
-        uom_clean = str(uom).strip().upper()
+        uom_clean = (uom if isinstance(uom, str) else str(uom)).strip().upper()
         
         # تحويل الجرام فقط إلى كيلوجرام
-        if uom_clean in ['G', 'GR', 'GRAM', 'GRAMS']:
+        if uom_clean in GRAM_UOMS:
             return quantity * 0.001, 'KG'  # تحويل من جرام إلى كيلوجرام
         else:
             # باقي الوحدات تبقى كما هي
@@ -236,80 +407,91 @@ class MRPCalculator:
         """Build BOM parent-component relationships and store descriptions"""
         try:
             # 🔥 تنظيف البيانات وإزالة التكرار قبل المعالجة
-            self.clean_bom_data(col_parent, col_component, col_qty, col_uom)
+            # (الأكواد تتكرر كثيراً، لذا ترجع category لتتم العمليات النصية على القيم الفريدة فقط)
+            parents, components = self.clean_bom_data(col_parent, col_component, col_qty, col_uom)
             
-            # بناء قاموس أوصاف المواد ووحدات القياس من شيت BOM
-            for _, row in self.bom_df.iterrows():
-                material_code = str(row[col_component]).strip()
-                
-                # تخزين الوصف من BOM (إذا لم يكن موجوداً في MRP Contor)
-                if col_component_description and pd.notna(row[col_component_description]):
-                    description = str(row[col_component_description]).strip()
-                    if material_code and description and material_code != 'nan' and material_code not in self.material_descriptions:
-                        self.material_descriptions[material_code] = description
-                
-                # تخزين وحدة القياس الأصلية
-                if col_uom and pd.notna(row[col_uom]):
-                    uom = str(row[col_uom]).strip()
-                    if material_code and uom and material_code != 'nan':
-                        self.material_uoms[material_code] = uom
-                        # تحديد الوحدة الموحدة
-                        converted_qty, standardized_uom = self.convert_quantity(1.0, uom)
-                        self.standardized_uoms[material_code] = standardized_uom
-                
-                # أيضا تخزين وصف ووحدات القياس للمواد الأب
-                parent_code = str(row[col_parent]).strip()
-                if col_component_description and pd.notna(row[col_component_description]):
-                    parent_desc = str(row[col_component_description]).strip()
-                    if parent_code and parent_desc and parent_code != 'nan' and parent_code not in self.material_descriptions:
-                        self.material_descriptions[parent_code] = parent_desc
-                
-                if col_uom and pd.notna(row[col_uom]):
-                    parent_uom = str(row[col_uom]).strip()
-                    if parent_code and parent_uom and parent_code != 'nan':
-                        self.material_uoms[parent_code] = parent_uom
-                        converted_qty, standardized_uom = self.convert_quantity(1.0, parent_uom)
-                        self.standardized_uoms[parent_code] = standardized_uom
+            bom = self.bom_df
+            
+            # ترتيب الأكواد كما في الصفوف: المكون ثم الأب لكل صف (قيم كل صف تكرر مرتين بنفس الترتيب بـ repeat)
+            # المصفوفة تملأ بالتبادل مباشرة بدلاً من concat ثم ترتيب
+            codes = np.empty(2 * len(components), dtype=object)
+            codes[0::2] = components.to_numpy(dtype=object)
+            codes[1::2] = parents.to_numpy(dtype=object)
+            codes = pd.Series(codes, index=components.index.repeat(2))
+            valid_codes = codes.ne('') & codes.ne('nan')
+            
+            # بناء قاموس أوصاف المواد من شيت BOM (إذا لم يكن موجوداً في MRP Contor)
+            if col_component_description:
+                descriptions = _clean_codes(bom[col_component_description])
+                descriptions = descriptions.where(bom[col_component_description].notna() & descriptions.ne(''))
+                descriptions = descriptions.repeat(2)
+                mask = valid_codes & descriptions.notna()
+                bom_descriptions = pd.Series(descriptions[mask].values, index=codes[mask].values)
+                bom_descriptions = bom_descriptions[
+                    ~bom_descriptions.index.duplicated(keep='first') &
+                    ~bom_descriptions.index.isin(list(self.material_descriptions))
+                ]
+                self.material_descriptions.update(zip(_interned(bom_descriptions.index), _deduplicated(bom_descriptions)))
+            
+            # تخزين وحدة القياس الأصلية والوحدة الموحدة (آخر قيمة هي المعتمدة)
+            if col_uom:
+                uoms = _clean_codes(bom[col_uom])
+                uoms = uoms.where(bom[col_uom].notna() & uoms.ne(''))
+                # معامل التحويل والوحدة الموحدة يحسبان مرة واحدة لكل وحدة فريدة
+                conversions = {uom: self.convert_quantity(1.0, uom) for uom in uoms.cat.categories}
+                standardized = uoms.map({uom: unit for uom, (_, unit) in conversions.items()})
+                uom_factors = uoms.map({uom: factor for uom, (factor, _) in conversions.items()}).astype(float).fillna(1.0)
+                uoms = uoms.repeat(2)
+                standardized = standardized.repeat(2)
+                mask = valid_codes & uoms.notna()
+                bom_uoms = pd.DataFrame({'uom': uoms[mask].values, 'std': standardized[mask].values}, index=codes[mask].values)
+                bom_uoms = bom_uoms[~bom_uoms.index.duplicated(keep='last')]
+                uom_codes = _interned(bom_uoms.index)
+                # الأوصاف والوحدات المتكررة بين المواد تخزن ككائن نص واحد لكل قيمة
+                self.material_uoms.update(zip(uom_codes, _deduplicated(bom_uoms['uom'])))
+                self.standardized_uoms.update(zip(uom_codes, _deduplicated(bom_uoms['std'])))
             
             # بناء علاقات BOM مع تحويل الوحدات
-            for _, row in self.bom_df.iterrows():
-                parent = str(row[col_parent]).strip()
-                comp = str(row[col_component]).strip()
-                
-                # Skip empty rows
-                if not parent or not comp or parent.lower() == 'nan' or comp.lower() == 'nan':
-                    continue
-                
-                # Handle quantity conversion
-                try:
-                    qty_val = row[col_qty]
-                    if pd.isna(qty_val):
-                        continue
-                    qty = float(str(qty_val).replace(",", "."))
-                    
-                    # تحويل الكمية بناءً على وحدة القياس
-                    if col_uom and pd.notna(row[col_uom]):
-                        uom = str(row[col_uom]).strip()
-                        converted_qty, _ = self.convert_quantity(qty, uom)
-                    else:
-                        converted_qty = qty
-                        
-                except (ValueError, TypeError):
-                    st.warning(f"⚠️ كمية غير صالحة لتخطيط {parent} -> {comp}: {qty_val}")
-                    continue
-                    
-                if converted_qty > 0:
-                    self.relations[parent].append((comp, converted_qty))
+            valid_rows = (
+                parents.ne('') & components.ne('') &
+                parents.str.lower().ne('nan') & components.str.lower().ne('nan')
+            )
+            quantities = _to_number(bom[col_qty])
+            
+            invalid = valid_rows & quantities.isna() & bom[col_qty].notna()
+            for parent, comp, qty_val in zip(parents[invalid], components[invalid], bom.loc[invalid, col_qty]):
+                st.warning(f"⚠️ كمية غير صالحة لتخطيط {parent} -> {comp}: {qty_val}")
+            
+            # تحويل الكمية بناءً على وحدة القياس
+            if col_uom:
+                quantities = quantities * uom_factors
+            
+            keep = valid_rows & quantities.gt(0)
+            # إعادة بناء العلاقات تلغي جميع النتائج المحفوظة
+            self._bom_adjacency = None
+            self._plan_matrices = {}
+            self._plan_materials = None
+            self._all_levels_df = None
+            self._requirements_df = None
+            self._raw_materials_df = None
+            self._monthly_summary = None
+            self._manufacturing_df = None
+            self._monthly_chart = None
+            self.relations = self._group_relations(
+                parents[keep], components[keep], quantities[keep].to_numpy(dtype=float)
+            )
+            
+            # تفجير الـ BOM لجميع المواد مرة واحدة من الأسفل للأعلى
+            self.build_explode_cache()
             
             st.success(f"✅ تم بناء علاقات BOM لـ {len(self.relations)} مادة أب")
             st.info(f"✅ تم تخزين أوصاف لـ {len(self.material_descriptions)} مادة")
             st.info(f"✅ تم تخزين وحدات قياس لـ {len(self.material_uoms)} مادة")
             
             # عرض إحصائيات التحويل
-            g_materials = [code for code, uom in self.material_uoms.items() 
-                          if str(uom).upper() in ['G', 'GR', 'GRAM', 'GRAMS']]
+            g_materials = sum(1 for uom in self.material_uoms.values() if uom.upper() in GRAM_UOMS)
             if g_materials:
-                st.info(f"🔁 سيتم تحويل {len(g_materials)} مادة من الجرام إلى الكيلوجرام")
+                st.info(f"🔁 سيتم تحويل {g_materials} مادة من الجرام إلى الكيلوجرام")
             
             return True
             
@@ -325,25 +507,173 @@ class MRPCalculator:
         """Get standardized UoM for material code"""
         return self.standardized_uoms.get(material_code, self.material_uoms.get(material_code, ""))
 
-    @lru_cache(maxsize=None)
-    def explode_unit(self, item_code: str) -> dict:
-        """Recursively explode BOM to raw materials"""
-        item = str(item_code).strip()
+    @staticmethod
+    def _group_relations(parents, components, quantities: np.ndarray) -> dict:
+        """تجميع صفوف الـ BOM حسب المادة الأب في مصفوفات (بترتيب أول ظهور للأب وترتيب الصفوف داخله)"""
+        if len(parents) == 0:
+            return {}
+        # التجميع يتم على أرقام الآباء (أرقام الـ category) ولا تقارن النصوص إلا للقيم الفريدة
+        parent_ids, unique_parents = pd.factorize(pd.Series(parents))
+        order = np.argsort(parent_ids, kind='stable')
+        boundaries = np.flatnonzero(np.diff(parent_ids[order])) + 1
+        component_arrays = np.split(np.array(_interned(components), dtype=object)[order], boundaries)
+        quantity_arrays = np.split(quantities[order], boundaries)
+        return {
+            sys.intern(str(parent)): (comps, qtys)
+            for parent, comps, qtys in zip(unique_parents, component_arrays, quantity_arrays)
+        }
+
+    def _leaf_id(self, item: str) -> int:
+        """رقم ثابت للمادة النهائية يستخدم كمفتاح في نتائج التفجير وكعمود في مصفوفة المتطلبات"""
+        leaf_id = self._leaf_ids.get(item)
+        if leaf_id is None:
+            leaf_id = self._leaf_ids[item] = len(self._leaf_codes)
+            self._leaf_codes.append(item)
+        return leaf_id
+
+    def _leaf_unit(self, item: str) -> tuple:
+        """تفجير مادة نهائية: نفسها بكمية 1"""
+        return np.array([self._leaf_id(item)]), np.ones(1)
+
+    def _index_relations(self):
+        """ترقيم مواد الـ BOM مرة واحدة لتكون مفاتيح الكاش والمصفوفات أرقاماً بدلاً من نصوص"""
+        parents = list(self.relations)
+        components = [self.relations[parent][0] for parent in parents]
+        material_ids, material_codes = pd.factorize(
+            np.concatenate([np.array(parents, dtype=object)] + components)
+        )
+        self._material_codes = material_codes.tolist()
+        self._material_ids = dict(zip(self._material_codes, range(len(self._material_codes))))
+        self._child_ptr = np.concatenate([[0], np.cumsum([len(comps) for comps in components], dtype=np.int64)])
+        self._child_ids = material_ids[len(parents):]
+        self._child_qtys = (
+            np.concatenate([self.relations[parent][1] for parent in parents]) if parents else np.zeros(0)
+        )
+        
+        # أنواع ومستويات جميع مواد الـ BOM دفعة واحدة (الآباء هم أول len(parents) رقم)
+        codes = pd.Series(self._material_codes, dtype=object)
+        material_types = codes.str[0].map(MATERIAL_TYPES).fillna('غير معروف')
+        self._material_types.update(zip(self._material_codes, material_types.tolist()))
+        # قناع الآباء التي تفجر (ليست مواد خام) بدلاً من فحص is_raw_material لكل أب
+        self._expandable = (material_types != 'مادة خام').to_numpy()[:len(parents)]
+        levels = material_types.map(MATERIAL_LEVELS).fillna(999).astype(int)
+        levels[(material_types == 'منتج مصنع').to_numpy() & (np.arange(len(codes)) < len(parents))] = 2
+        self._material_levels = dict(zip(self._material_codes, levels.tolist()))
+
+    def _relation_edges(self) -> tuple:
+        """روابط الـ BOM كمصفوفات متوازية: (رقم الأب، رقم المكون، الكمية)"""
+        rows = np.repeat(np.arange(len(self._child_ptr) - 1), np.diff(self._child_ptr))
+        return rows, self._child_ids, self._child_qtys
+
+    @staticmethod
+    def _cycle_edges(rows: np.ndarray, cols: np.ndarray, n_materials: int) -> np.ndarray:
+        """قناع الروابط داخل نفس المكون القوي الترابط (أي التي تغلق علاقة دائرية)"""
+        _, labels = csgraph.connected_components(
+            sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n_materials, n_materials)),
+            directed=True, connection='strong'
+        )
+        return labels[rows] == labels[cols]
+
+    def build_explode_cache(self):
+        """تفجير الـ BOM لجميع المواد دفعة واحدة: مستوى بمستوى بترتيب الاعتماد بضرب مصفوفات متفرقة"""
+        self._index_relations()
+        n_materials = len(self._material_codes)
+        self._leaf_ids = {}
+        self._leaf_codes = []
         
-        # إذا كانت المادة خام أو ليس لها مكونات، تعامل كمادة خام
-        if self.is_raw_material(item) or item not in self.relations or not self.relations[item]:
-            return {item: 1.0}
-            
-        total = defaultdict(float)
-        for comp, qty in self.relations[item]:
-            sub_map = self.explode_unit(comp)
-            for material, quantity in sub_map.items():
-                total[material] += quantity * qty
-                
-        return dict(total)
+        # كسر العلاقات الدائرية بين المواد التي تفجر: المكون الذي يغلق الدورة يعامل كمادة خام
+        rows, cols, data = self._relation_edges()
+        expandable = np.zeros(n_materials, dtype=bool)
+        expandable[:len(self._expandable)] = self._expandable
+        explode_edges = np.flatnonzero(expandable[rows] & expandable[cols])
+        self._cut_edges = np.zeros(len(rows), dtype=bool)
+        self._cut_edges[explode_edges] = self._cycle_edges(rows[explode_edges], cols[explode_edges], n_materials)
+        
+        # روابط الآباء التي تفجر: المكون الذي يفجر بدوره رابط اعتماد، وغيره (خام أو يغلق دورة) مادة نهائية مباشرة
+        from_expandable = expandable[rows]
+        dependency = from_expandable & expandable[cols] & ~self._cut_edges
+        direct = np.flatnonzero(from_expandable & ~dependency)
+        leaves, leaf_positions = np.unique(cols[direct], return_inverse=True)
+        leaf_ids = np.array([self._leaf_id(self._material_codes[leaf]) for leaf in leaves.tolist()], dtype=np.int64)
+        exploded = sparse.csr_matrix(
+            (data[direct], (rows[direct], leaf_ids[leaf_positions])), shape=(n_materials, len(self._leaf_codes))
+        )
+        
+        # المواد التي اكتملت مكوناتها تحسب معاً: تفجيرها = روابطها المباشرة + (الأب × المكون) @ تفجير مكوناتها
+        dependency_rows, dependency_cols = rows[dependency], cols[dependency]
+        flow = sparse.csr_matrix(
+            (data[dependency], (dependency_rows, dependency_cols)), shape=(n_materials, n_materials)
+        )
+        pending = np.bincount(dependency_rows, minlength=n_materials)
+        ready = np.flatnonzero(expandable & (pending == 0))
+        while len(ready):
+            is_ready = np.zeros(n_materials, dtype=bool)
+            is_ready[ready] = True
+            done = is_ready[dependency_cols]
+            pending -= np.bincount(dependency_rows[done], minlength=n_materials)
+            parents = np.unique(dependency_rows[done])
+            ready = parents[pending[parents] == 0]
+            if len(ready):
+                scatter = sparse.csr_matrix(
+                    (np.ones(len(ready)), (ready, np.arange(len(ready)))), shape=(n_materials, len(ready))
+                )
+                exploded = exploded + scatter @ (flow[ready] @ exploded)
+        exploded.sum_duplicates()
+        self._exploded = exploded
+        
+        if self._cut_edges.any():
+            cyclic = [self._material_codes[parent] for parent in np.unique(rows[self._cut_edges]).tolist()]
+            st.warning(f"⚠️ تم اكتشاف علاقات دائرية في الـ BOM تخص المواد: {', '.join(cyclic[:10])}")
+
+    def explode_unit(self, item: str) -> tuple:
+        """Explode BOM to raw materials as (leaf ids, quantities) arrays (item must be a stripped code)"""
+        material_id = self._material_ids.get(item)
+        if material_id is None:
+            # مادة ليست في الـ BOM تعامل كمادة خام
+            return self._leaf_unit(item)
+        start, end = self._exploded.indptr[material_id:material_id + 2]
+        if start == end:
+            # مادة لا تفجر (خام أو مكون نهائي) تعامل كمادة نهائية
+            return self._leaf_unit(item)
+        return self._exploded.indices[start:end], self._exploded.data[start:end]
+
+    def build_bom_adjacency(self):
+        """مصفوفة الـ BOM المتفرقة (الأب × المكون = الكمية) بنفس أرقام المواد المستخدمة في التفجير"""
+        n_materials = len(self._material_codes)
+        # كسر العلاقات الدائرية: حذف الروابط داخل نفس المكون القوي الترابط
+        rows, cols, data = self._relation_edges()
+        acyclic = ~self._cycle_edges(rows, cols, n_materials)
+        self._bom_adjacency = sparse.csr_matrix(
+            (data[acyclic], (rows[acyclic], cols[acyclic])), shape=(n_materials, n_materials)
+        )
+
+    def get_plan_matrix(self, month_cols) -> np.ndarray:
+        """مصفوفة كميات الخطة (صفوف الخطة × الشهور) - القيم الفارغة أو غير الرقمية تصبح صفراً"""
+        key = tuple(month_cols)
+        plan_matrix = self._plan_matrices.get(key)
+        if plan_matrix is None:
+            if len(month_cols) == 0:
+                plan_matrix = np.zeros((len(self.plan_df), 0))
+            else:
+                plan_matrix = np.column_stack(
+                    [_to_number(self.plan_df[month]).fillna(0).to_numpy(dtype=float) for month in month_cols]
+                )
+            # المصفوفة مشتركة بين جميع الحسابات فلا يسمح بتعديلها
+            plan_matrix.flags.writeable = False
+            self._plan_matrices[key] = plan_matrix
+        return plan_matrix
+
+    def get_plan_materials(self) -> tuple:
+        """أكواد مواد الخطة (العمود الأول) منظفة كـ category، مع قناع الصفوف التي لها كود صالح (ليس فارغاً أو nan/none)"""
+        if self._plan_materials is None:
+            codes = _clean_codes(self.plan_df.iloc[:, 0])
+            self._plan_materials = codes, ~codes.str.lower().isin(['nan', 'none', '']).to_numpy()
+        return self._plan_materials
 
     def calculate_requirements(self) -> pd.DataFrame:
         """Calculate material requirements based on production plan"""
+        if self._requirements_df is not None:
+            return self._requirements_df
         plan_cols = list(self.plan_df.columns)
         
         # Identify FG and month columns
@@ -356,73 +686,65 @@ class MRPCalculator:
         
         st.info(f"✅ تم تحديد أعمدة الخطة: FG={fg_col}, الشهور={len(month_cols)}")
         
-        results = defaultdict(lambda: defaultdict(float))
-        material_codes = set()  # لتخزين جميع أكواد المواد
+        # مصفوفة الخطة (صفوف الخطة × الشهور) - القيم غير الرقمية تعامل كصفر
+        plan_fgs, valid_rows = self.get_plan_materials()
+        plan_matrix = self.get_plan_matrix(month_cols)
         
-        # Progress bar
-        progress_bar = st.progress(0)
-        total_items = len(self.plan_df)
+        # تجميع صفوف الخطة لكل FG (نفس المنتج قد يتكرر بأكثر من نوع طلب) لتفجيره مرة واحدة فقط
+        fg_ids, unique_fgs = pd.factorize(plan_fgs[valid_rows])
+        selector = sparse.csr_matrix(
+            (np.ones(len(fg_ids)), (fg_ids, np.arange(len(fg_ids)))),
+            shape=(len(unique_fgs), len(fg_ids))
+        )
+        fg_plan = selector @ plan_matrix[valid_rows]
+        # الـ FG الذي له صف خطة بكمية مخططة (غير صفرية) في أي شهر - غيره لا يضيف شيئاً فيستبعد قبل الضرب
+        fg_planned = np.flatnonzero((selector @ (plan_matrix[valid_rows] != 0).any(axis=1).astype(float)) > 0)
+        fg_plan = fg_plan[fg_planned]
         
-        for idx, (_, prow) in enumerate(self.plan_df.iterrows()):
-            fg = str(prow[fg_col]).strip()
-            if not fg or fg.lower() in ['nan', 'none', '']:
-                continue
-                
-            bom_map = self.explode_unit(fg)
-            
-            for month in month_cols:
-                try:
-                    planned_qty = prow[month]
-                    if pd.isna(planned_qty):
-                        continue
-                    planned = float(str(planned_qty).replace(",", "."))
-                except (ValueError, TypeError):
-                    continue
-                    
-                if planned == 0:
-                    continue
-                    
-                for raw_material, per_unit in bom_map.items():
-                    results[raw_material][month] += planned * per_unit
-                    material_codes.add(raw_material)
-            
-            # Update progress
-            progress_bar.progress((idx + 1) / total_items)
+        # مصفوفة الـ BOM المفجرة (FG × المواد النهائية) بصيغة متفرقة
+        # (التفجير محسوب مسبقاً فالحلقة قراءة من الكاش فقط، والتقدم يظهر عبر st.spinner في show_analysis)
+        compositions = [self.explode_unit(fg) for fg in _interned(unique_fgs[fg_planned])]
+        if compositions:
+            cols = np.concatenate([leaf_ids for leaf_ids, _ in compositions])
+            data = np.concatenate([quantities for _, quantities in compositions])
+            rows = np.repeat(np.arange(len(compositions)), [len(leaf_ids) for leaf_ids, _ in compositions])
+        else:
+            rows = cols = np.zeros(0, dtype=int)
+            data = np.zeros(0)
         
         st.success(f"✅ تم معالجة {len(self.plan_df)} من مواد التخطيط")
         
+        bom_matrix = sparse.csr_matrix(
+            (data, (rows, cols)), shape=(len(fg_planned), len(self._leaf_codes))
+        )
+        
+        # المواد التي دخلت في FG له كمية مخططة
+        touched = bom_matrix.getnnz(axis=0) > 0
+        
         # Create output DataFrame with descriptions and STANDARDIZED UoM
-        raw_list = sorted(material_codes)
-        
-        # إضافة أعمدة الوصف ووحدة القياس الموحدة و MRP Contor ونوع المادة
-        descriptions = [self.get_material_description(material) for material in raw_list]
-        standardized_uoms = [self.get_standardized_uom(material) for material in raw_list]
-        mrp_controls = [self.get_mrp_control_value(material) for material in raw_list]
-        material_types = [self.get_material_type(material) for material in raw_list]
-        material_levels = [self.get_material_level(material) for material in raw_list]
-        
-        # إنشاء DataFrame النهائي
-        out_df = pd.DataFrame({
-            'Material_Code': raw_list,
-            'Material_Description': descriptions,
-            'Material_Type': material_types,
-            'Level': material_levels,
-            'UoM': standardized_uoms,
-            'MRP_Contor': mrp_controls
-        })
+        # ✅ التعديل: تصفية المواد التي تبدأ بالرقم 1 فقط (قبل بناء أعمدة الشهور)
+        raw_list = sorted(
+            code for code in (self._leaf_codes[col] for col in np.flatnonzero(touched))
+            if code.startswith('1')
+        )
+        # مصفوفة المتطلبات (المواد × الشهور) تحسب لصفوف النتيجة فقط
+        # بترتيب أعمدة (Fortran) حتى يلفها DataFrame كما هي بدون نسخ وكل شهر متصل في الذاكرة
+        raw_cols = [self._leaf_ids[material] for material in raw_list]
+        raw_requirements = np.asfortranarray(
+            np.asarray(bom_matrix.tocsc()[:, raw_cols].T @ fg_plan).reshape(len(raw_list), len(month_cols))
+        )
         
-        # إضافة أعمدة الشهور
-        for month in month_cols:
-            month_data = [results[material].get(month, 0.0) for material in raw_list]
-            out_df[str(month)] = month_data
+        # إنشاء DataFrame النهائي مع أعمدة الوصف ووحدة القياس الموحدة و MRP Contor ونوع المادة
+        out_df = self.material_attributes(raw_list)
+        out_df.insert(0, 'Material_Code', raw_list)
         
-        # حساب الإجمالي
+        # إضافة أعمدة الشهور والإجمالي
         month_columns = [str(col) for col in month_cols]
-        out_df['Total_Required'] = out_df[month_columns].sum(axis=1)
-        
-        # ✅ التعديل: تصفية المواد التي تبدأ بالرقم 1 فقط
-        out_df = out_df[out_df['Material_Code'].astype(str).str.startswith('1')]
+        out_df = pd.concat(
+            [out_df, pd.DataFrame(raw_requirements, columns=month_columns, copy=False)], axis=1
+        ).assign(Total_Required=raw_requirements.sum(axis=1))
         
+        self._requirements_df = out_df
         return out_df
 
     def calculate_manufacturing_quantities(self):
@@ -434,19 +756,22 @@ class MRPCalculator:
                 st.warning("⚠️ لا توجد بيانات لحساب كميات التصنيع")
                 return False
             
-            # مسح كميات التصنيع السابقة
-            self.manufacturing_quantities = {}
-            
             # المكونات الوسيطة هي المنتجات المصنعة (تبدأ بـ 4) ولها كمية مطلوبة
             intermediate_components = all_levels_df[
-                (all_levels_df['Material_Type'] == 'منتج مصنع') & 
-                (all_levels_df['Total_Required'] > 0)
+                (all_levels_df['Material_Type'] == 'منتج مصنع').to_numpy() & 
+                (all_levels_df['Total_Required'].to_numpy() > 0)
             ]
-            
-            for _, row in intermediate_components.iterrows():
-                material = row['Material_Code']
-                total_required = row['Total_Required']
-                self.manufacturing_quantities[material] = total_required
+            manufacturing_totals = intermediate_components['Total_Required'].to_numpy()
+            self.manufacturing_quantities = dict(zip(
+                intermediate_components['Material_Code'].tolist(),
+                manufacturing_totals.tolist()
+            ))
+            # شيت كميات التصنيع في ملف النتائج يبنى من نفس الصفوف مرة واحدة (بدون استدعاء الصفات لكل مادة)
+            self._manufacturing_df = intermediate_components.rename(columns={
+                'Material_Code': 'Material',
+                'Material_Description': 'Description',
+                'Total_Required': 'Manufacturing_Quantity'
+            })[['Material', 'Description', 'Material_Type', 'Level', 'Manufacturing_Quantity', 'MRP_Contor']]
             
             st.success(f"✅ تم حساب كميات التصنيع لـ {len(self.manufacturing_quantities)} مكون وسيط")
             
@@ -457,32 +782,27 @@ class MRPCalculator:
                 # إحصائيات سريعة
                 col1, col2, col3 = st.columns(3)
                 with col1:
-                    total_manufacturing_qty = sum(self.manufacturing_quantities.values())
+                    total_manufacturing_qty = float(manufacturing_totals.sum())
                     st.metric("إجمالي كميات التصنيع", f"{total_manufacturing_qty:,.0f}")
                 with col2:
-                    avg_per_component = total_manufacturing_qty / len(self.manufacturing_quantities) if self.manufacturing_quantities else 0
+                    avg_per_component = float(manufacturing_totals.mean())
                     st.metric("متوسط الكمية لكل مكون", f"{avg_per_component:,.0f}")
                 with col3:
-                    max_level = max([self.get_material_level(mat) for mat in self.manufacturing_quantities.keys()]) if self.manufacturing_quantities else 0
+                    max_level = int(intermediate_components['Level'].to_numpy().max())
                     st.metric("أعلى مستوى للمكونات", max_level)
                 
-                # عرض البيانات
-                manufacturing_data = []
-                for material, qty in list(self.manufacturing_quantities.items()):
-                    manufacturing_data.append({
-                        'كود المادة': material,
-                        'الوصف': self.get_material_description(material),
-                        'نوع المادة': self.get_material_type(material),
-                        'المستوى': self.get_material_level(material),
-                        'كمية التصنيع المطلوبة': qty,
-                        'الوحدة': self.get_standardized_uom(material),
-                        'MRP Contor': self.get_mrp_control_value(material)
-                    })
-                
-                if manufacturing_data:
-                    manufacturing_df = pd.DataFrame(manufacturing_data)
-                    manufacturing_df = manufacturing_df.sort_values(['المستوى', 'كمية التصنيع المطلوبة'], ascending=[True, False])
-                    st.dataframe(manufacturing_df, use_container_width=True)
+                # عرض البيانات (نفس صفوف جميع المستويات بأسماء أعمدة العرض)
+                manufacturing_df = intermediate_components.rename(columns={
+                    'Material_Code': 'كود المادة',
+                    'Material_Description': 'الوصف',
+                    'Material_Type': 'نوع المادة',
+                    'Level': 'المستوى',
+                    'Total_Required': 'كمية التصنيع المطلوبة',
+                    'Standardized_UoM': 'الوحدة',
+                    'MRP_Contor': 'MRP Contor'
+                })[['كود المادة', 'الوصف', 'نوع المادة', 'المستوى', 'كمية التصنيع المطلوبة', 'الوحدة', 'MRP Contor']]
+                manufacturing_df = manufacturing_df.sort_values(['المستوى', 'كمية التصنيع المطلوبة'], ascending=[True, False])
+                _show_page(manufacturing_df, "manufacturing_page")
             
             else:
                 st.warning("⚠️ لم يتم العثور على مكونات وسيطة تحتاج تصنيع")
@@ -501,85 +821,91 @@ class MRPCalculator:
 
     def calculate_all_levels_requirements(self):
         """حساب الكميات المطلوبة لجميع مستويات الـ BOM"""
+        if self._all_levels_df is not None:
+            return self._all_levels_df
         try:
             # تحديد أعمدة الشهور من الخطة
             month_cols = self.plan_df.columns[2:] if "Material Description" in self.plan_df.columns else self.plan_df.columns[1:]
             
-            # نتائج جميع المستويات
-            all_levels_results = defaultdict(lambda: defaultdict(float))
+            if self._bom_adjacency is None:
+                self.build_bom_adjacency()
             
-            # معالجة كل مادة في الخطة
-            for _, row in self.plan_df.iterrows():
-                parent = str(row.iloc[0]).strip()
-                if not parent:
-                    continue
-                
-                # حساب الكميات لكل شهر
-                for month in month_cols:
-                    try:
-                        planned_qty = row[month]
-                        if pd.isna(planned_qty) or planned_qty == 0:
-                            continue
-                        planned = float(str(planned_qty).replace(",", "."))
-                    except (ValueError, TypeError):
-                        continue
-                    
-                    # إضافة المادة الأصلية
-                    all_levels_results[parent][month] += planned
-                    
-                    # حساب الكميات لجميع المستويات باستخدام BOM
-                    self._calculate_component_requirements(parent, planned, month, all_levels_results)
-            
-            # إنشاء DataFrame لجميع المستويات
-            all_materials = sorted(all_levels_results.keys())
-            
-            all_levels_data = []
-            for material in all_materials:
-                row_data = {
-                    'Material_Code': material,
-                    'Material_Description': self.get_material_description(material),
-                    'Material_Type': self.get_material_type(material),
-                    'Level': self.get_material_level(material),
-                    'Standardized_UoM': self.get_standardized_uom(material),
-                    'MRP_Contor': self.get_mrp_control_value(material),
-                    'Total_Required': sum(all_levels_results[material].values())
-                }
-                
-                # إضافة الكميات لكل شهر
-                for month in month_cols:
-                    row_data[str(month)] = all_levels_results[material].get(month, 0.0)
-                
-                all_levels_data.append(row_data)
+            # صفوف الخطة (الكميات محولة لأرقام مرة واحدة) - الصفوف بدون أي كمية مخططة لا تضيف شيئاً
+            plan_parents, valid_rows = self.get_plan_materials()
+            plan_matrix = self.get_plan_matrix(month_cols)
+            active = (plan_matrix != 0).any(axis=1) & valid_rows
+            
+            # تجميع الخطة لكل مادة أب
+            parent_ids, unique_parents = pd.factorize(plan_parents[active])
+            selector = sparse.csr_matrix(
+                (np.ones(len(parent_ids)), (parent_ids, np.arange(len(parent_ids)))),
+                shape=(len(unique_parents), len(parent_ids))
+            )
+            parent_plan = selector @ plan_matrix[active]
+            
+            # أرقام المواد: مواد الـ BOM أولاً ثم مواد الخطة غير الموجودة في الـ BOM
+            material_codes = list(self._material_ids)
+            n_bom = len(material_codes)
+            parent_rows = []
+            for parent in _interned(unique_parents):
+                material_id = self._material_ids.get(parent)
+                if material_id is None:
+                    material_id = len(material_codes)
+                    material_codes.append(parent)
+                parent_rows.append(material_id)
+            parent_rows = np.array(parent_rows, dtype=np.int64)
             
-            all_levels_df = pd.DataFrame(all_levels_data)
+            # كميات الخطة تنزل في الـ BOM مستوى بمستوى: المستوى التالي = (الأب × المكون)ᵀ @ المستوى الحالي
+            # لجميع الشهور معاً، والعمود الأخير يتتبع المواد التي وصلها الحساب حتى لو كانت كميتها صفراً
+            in_bom = np.flatnonzero(parent_rows < n_bom)
+            level = np.zeros((n_bom, len(month_cols) + 1))
+            level[parent_rows[in_bom], :-1] = parent_plan[in_bom]
+            level[parent_rows[in_bom], -1] = 1.0
+            flow = self._bom_adjacency.T.tocsr()
+            component_totals = np.zeros_like(level)
+            while True:
+                level = flow @ level
+                if not level[:, -1].any():
+                    break
+                component_totals += level
+            
+            included = np.zeros(len(material_codes), dtype=bool)
+            included[:n_bom] = component_totals[:, -1] > 0
+            included[parent_rows] = True
+            
+            # ترتيب المواد في النتيجة، والكميات تحسب لهذه الصفوف فقط
+            order = sorted(np.flatnonzero(included).tolist(), key=material_codes.__getitem__)
+            all_materials = [material_codes[i] for i in order]
+            positions = np.empty(len(material_codes), dtype=np.int64)
+            positions[order] = np.arange(len(order))
+            
+            quantities = np.zeros((len(order), len(month_cols)), order='F')
+            components = np.flatnonzero(included[:n_bom])
+            quantities[positions[components]] = component_totals[components, :-1]
+            # إضافة المادة الأصلية
+            quantities[positions[parent_rows]] += parent_plan
             
-            # إعادة ترتيب الأعمدة
-            base_cols = ['Material_Code', 'Material_Description', 'Material_Type', 'Level', 'Standardized_UoM', 'MRP_Contor', 'Total_Required']
             month_cols_sorted = [str(col) for col in month_cols]
-            all_cols = base_cols + month_cols_sorted
+            all_levels_df = self.material_attributes(all_materials).rename(columns={'UoM': 'Standardized_UoM'})
+            all_levels_df.insert(0, 'Material_Code', all_materials)
+            all_levels_df['Total_Required'] = quantities.sum(axis=1)
+            all_levels_df = pd.concat(
+                [all_levels_df, pd.DataFrame(quantities, columns=month_cols_sorted, copy=False)], axis=1
+            )
             
-            all_levels_df = all_levels_df[all_cols]
             all_levels_df = all_levels_df.sort_values(['Level', 'Material_Code'])
             
+            self._all_levels_df = all_levels_df
             return all_levels_df
             
         except Exception as e:
             st.error(f"❌ خطأ في حساب جميع المستويات: {e}")
             return pd.DataFrame()
 
-    def _calculate_component_requirements(self, parent, parent_qty, month, results_dict):
-        """دالة مساعدة لحساب متطلبات المكونات بشكل متكرر"""
-        if parent not in self.relations:
-            return
-        
-        for comp, comp_qty in self.relations[parent]:
-            required_qty = parent_qty * comp_qty
-            results_dict[comp][month] += required_qty
-            # استدعاء متكرر للمكونات التالية
-            self._calculate_component_requirements(comp, required_qty, month, results_dict)
-
     def generate_raw_materials_sheet(self):
         """إنشاء شيت للمواد الخام (تبدأ بـ 1)"""
+        if self._raw_materials_df is not None:
+            return self._raw_materials_df
         try:
             all_levels_df = self.calculate_all_levels_requirements()
             if all_levels_df.empty:
@@ -591,6 +917,7 @@ class MRPCalculator:
             ].copy()
             
             st.info(f"✅ تم تحديد {len(raw_materials_df)} مادة خام")
+            self._raw_materials_df = raw_materials_df
             return raw_materials_df
             
         except Exception as e:
@@ -599,6 +926,8 @@ class MRPCalculator:
 
     def create_monthly_summary(self):
         """إنشاء ملخص شهري للكميات حسب نوع الأمر"""
+        if self._monthly_summary is not None:
+            return self._monthly_summary
         try:
             if "Order Type" not in self.plan_df.columns:
                 st.warning("⚠️ عمود 'Order Type' غير موجود في شيت Plan")
@@ -610,28 +939,24 @@ class MRPCalculator:
                 # إذا لم تكن هناك تواريخ، استخدم الأعمدة الرقمية بعد العمودين الأولين
                 date_cols = self.plan_df.columns[2:] if "Material Description" in self.plan_df.columns else self.plan_df.columns[1:]
             
-            orders_summary = self.plan_df.melt(
-                id_vars=["Material", "Order Type"],
-                value_vars=date_cols,
-                var_name="Month",
-                value_name="Quantity"
-            )
+            # تحويل أسماء الأعمدة (وليس القيم) إلى أسماء الشهور مرة واحدة - الأعمدة التي ليست تواريخ تستبعد
+            if all(isinstance(c, (datetime.datetime, pd.Timestamp)) for c in date_cols):
+                month_dates = pd.DatetimeIndex(date_cols)
+            else:
+                month_dates = pd.to_datetime(pd.Index(date_cols, dtype=object), errors="coerce")
+            month_names = {
+                col: date.month_name() for col, date in zip(date_cols, month_dates) if not pd.isna(date)
+            }
             
-            # تحويل الشهور إلى أسماء إذا كانت تواريخ
-            try:
-                orders_summary["Month"] = pd.to_datetime(orders_summary["Month"], errors="coerce")
-                orders_summary = orders_summary.dropna(subset=["Month"])
-                orders_summary["Month"] = orders_summary["Month"].dt.month_name()
-            except:
-                pass  # إذا لم تكن تواريخ، استخدم الأسماء كما هي
-
-            orders_grouped = orders_summary.groupby(
-                ["Month", "Order Type"]
-            ).agg({"Quantity": "sum"}).reset_index()
-
-            pivot_df = orders_grouped.pivot_table(
-                index="Month", columns="Order Type", values="Quantity", aggfunc="sum", fill_value=0
-            ).reset_index()
+            # الكميات من مصفوفة الخطة المحولة لأرقام (تقبل الفاصلة العشرية "7,5")
+            month_list = list(month_names)
+            quantities = pd.DataFrame(self.get_plan_matrix(month_list), columns=month_list, index=self.plan_df.index)
+            # مجموع كل نوع أمر لكل عمود شهر (مصفوفة صغيرة: الأنواع × الشهور) بدلاً من melt لكل صف × شهر
+            # ثم جمع الأعمدة التي لها نفس اسم الشهر بعد قلبها (الشهور × الأنواع)
+            order_totals = quantities.groupby(self.plan_df["Order Type"]).sum()
+            pivot_df = order_totals.T.groupby(
+                pd.Index([month_names[col] for col in month_list], name="Month")
+            ).sum().reset_index()
 
             pivot_df["الإجمالي"] = pivot_df.sum(axis=1, numeric_only=True)
             
@@ -641,227 +966,269 @@ class MRPCalculator:
             if 'L' in pivot_df.columns:
                 pivot_df["L%"] = (pivot_df["L"] / pivot_df["الإجمالي"] * 100).round(1).astype(str) + "%"
             
+            self._monthly_summary = pivot_df
             return pivot_df
             
         except Exception as e:
             st.error(f"❌ خطأ في إنشاء الملخص الشهري: {e}")
             return pd.DataFrame()
 
-    def run(self):
-        """Main execution method"""
-        # File upload section
-        st.header("📁 رفع ملف الخطة")
+    def create_monthly_chart(self):
+        """رسم الكميات الشهرية حسب نوع الأمر - يبنى مرة واحدة ويعاد استخدامه عند إعادة التشغيل"""
+        if self._monthly_chart is None:
+            monthly_summary = self.create_monthly_summary()
+            # أعمدة أنواع الأوامر أرقام من مصفوفة الخطة مباشرة فلا تحتاج تحويلاً
+            numeric_cols = [c for c in monthly_summary.columns if c not in ["Month", "الإجمالي", "E%", "L%"]]
+            self._monthly_chart = px.bar(
+                monthly_summary,
+                x="Month",
+                y=numeric_cols,
+                barmode="group",
+                text_auto=True,
+                title="توزيع الكميات حسب نوع الأمر",
+                template="streamlit"
+            )
+        return self._monthly_chart
+
+    def prepare(self, uploaded_file) -> bool:
+        """تحميل البيانات وتحضير MRP Contor وبناء علاقات الـ BOM"""
+        # Load data
+        if not self.load_data(uploaded_file):
+            return False
         
-        uploaded_file = st.file_uploader(
-            "اختر ملف Excel الذي يحتوي على شيت Plan وBOM (واختياري: MRP Contor)",
-            type=["xlsx", "xls"],
-            help="يجب أن يحتوي الملف على شيتين: 'Plan' و 'BOM' - واختياري: 'MRP Contor'"
-        )
+        # Process MRP Control data first
+        if not self.prepare_mrp_control_data():
+            return False
         
-        if uploaded_file is not None:
-            try:
-                # Load data
-                if not self.load_data(uploaded_file):
-                    return
-                
-                # Show data preview
-                if self.mrp_control_df is not None:
-                    col1, col2, col3 = st.columns(3)
-                    
-                    with col1:
-                        st.subheader("معاينة بيانات الخطة (Plan)")
-                        st.dataframe(self.plan_df.head(), use_container_width=True)
-                    
-                    with col2:
-                        st.subheader("معاينة بيانات BOM")
-                        st.dataframe(self.bom_df.head(), use_container_width=True)
-                    
-                    with col3:
-                        st.subheader("معاينة بيانات MRP Contor")
-                        st.dataframe(self.mrp_control_df.head(), use_container_width=True)
-                else:
-                    col1, col2 = st.columns(2)
-                    
-                    with col1:
-                        st.subheader("معاينة بيانات الخطة (Plan)")
-                        st.dataframe(self.plan_df.head(), use_container_width=True)
-                    
-                    with col2:
-                        st.subheader("معاينة بيانات BOM")
-                        st.dataframe(self.bom_df.head(), use_container_width=True)
-                
-                # Process MRP Control data first
-                if not self.prepare_mrp_control_data():
-                    return
-                
-                # Process BOM
-                col_parent, col_component, col_qty, col_component_description, col_uom = self.prepare_bom_columns()
-                if not all([col_parent, col_component, col_qty]):
-                    return
-                
-                if not self.build_bom_relations(col_parent, col_component, col_qty, col_component_description, col_uom):
-                    return
-                
-                # Show material info sample
-                if self.material_descriptions or self.material_uoms:
-                    st.subheader("📝 عينة من بيانات المواد")
-                    sample_data = []
-                    materials = list(self.material_descriptions.keys())[:10]
-                    for material in materials:
-                        material_type = self.get_material_type(material)
-                        sample_data.append({
-                            'كود المادة': material,
-                            'نوع المادة': material_type,
-                            'المستوى': self.get_material_level(material),
-                            'وصف المكون': self.get_material_description(material),
-                            'الوحدة': self.get_standardized_uom(material),
-                            'MRP Contor': self.get_mrp_control_value(material)
-                        })
-                    if sample_data:
-                        sample_df = pd.DataFrame(sample_data)
-                        st.dataframe(sample_df, use_container_width=True)
-                    
-                    if len(self.material_descriptions) > 10:
-                        st.info(f"... وعرض {len(self.material_descriptions) - 10} مادة أخرى")
+        # Process BOM
+        col_parent, col_component, col_qty, col_component_description, col_uom = self.prepare_bom_columns()
+        if not all([col_parent, col_component, col_qty]):
+            return False
+        
+        return self.build_bom_relations(col_parent, col_component, col_qty, col_component_description, col_uom)
+
+    def show_analysis(self):
+        """عرض معاينة البيانات وكميات التصنيع وحساب متطلبات المواد"""
+        # Show data preview
+        if self.mrp_control_df is not None:
+            col1, col2, col3 = st.columns(3)
+            
+            with col1:
+                st.subheader("معاينة بيانات الخطة (Plan)")
+                st.dataframe(self.plan_df.head(), use_container_width=True)
+            
+            with col2:
+                st.subheader("معاينة بيانات BOM")
+                st.dataframe(self.bom_df.head(), use_container_width=True)
+            
+            with col3:
+                st.subheader("معاينة بيانات MRP Contor")
+                st.dataframe(self.mrp_control_df.head(), use_container_width=True)
+        else:
+            col1, col2 = st.columns(2)
+            
+            with col1:
+                st.subheader("معاينة بيانات الخطة (Plan)")
+                st.dataframe(self.plan_df.head(), use_container_width=True)
+            
+            with col2:
+                st.subheader("معاينة بيانات BOM")
+                st.dataframe(self.bom_df.head(), use_container_width=True)
+        
+        # Show material info sample
+        if self.material_descriptions or self.material_uoms:
+            st.subheader("📝 عينة من بيانات المواد")
+            sample_data = []
+            materials = list(self.material_descriptions.keys())[:10]
+            for material in materials:
+                material_type = self.get_material_type(material)
+                sample_data.append({
+                    'كود المادة': material,
+                    'نوع المادة': material_type,
+                    'المستوى': self.get_material_level(material),
+                    'وصف المكون': self.get_material_description(material),
+                    'الوحدة': self.get_standardized_uom(material),
+                    'MRP Contor': self.get_mrp_control_value(material)
+                })
+            if sample_data:
+                sample_df = pd.DataFrame(sample_data)
+                st.dataframe(sample_df, use_container_width=True)
+            
+            if len(self.material_descriptions) > 10:
+                st.info(f"... وعرض {len(self.material_descriptions) - 10} مادة أخرى")
+        
+        # Calculate manufacturing quantities
+        self.calculate_manufacturing_quantities()
+        
+        # Calculate requirements
+        # النتائج تبقى معروضة بعد الضغط عبر session_state، فتغيير الصفحة أو فتح الرسم البياني (إعادة تشغيل) لا يخفيها
+        calculate_clicked = st.button(
+            "🚀 حساب متطلبات المواد", type="primary", on_click=_set_calculated, args=(True,)
+        )
+        if st.session_state.get("mrp_calculated"):
+            with st.spinner("جاري حساب متطلبات المواد..."):
+                requirements_df = self.calculate_requirements()
+                all_levels_df = self.calculate_all_levels_requirements()
+                raw_materials_df = self.generate_raw_materials_sheet()
+                monthly_summary = self.create_monthly_summary()
+            
+            # Display results
+            st.header("📊 نتائج متطلبات المواد")
+            
+            # إحصائيات سريعة (محسوبة مرة واحدة على مصفوفات numpy)
+            total_materials = len(requirements_df)
+            total_req = float(requirements_df['Total_Required'].to_numpy().sum())
+            kg_materials = int((requirements_df['UoM'] == 'KG').to_numpy().sum())
+            materials_with_mrp = int((requirements_df['MRP_Contor'] != '').to_numpy().sum())
+            
+            col1, col2, col3, col4 = st.columns(4)
+            with col1:
+                st.metric("المواد الخام", total_materials)
+            with col2:
+                st.metric("إجمالي المتطلبات", f"{total_req:,.0f}")
+            with col3:
+                st.metric("المواد بالكيلوجرام", kg_materials)
+            with col4:
+                st.metric("مواد ذات MRP Contor", f"{materials_with_mrp}/{total_materials}")
+            
+            # عرض المواد الخام فقط
+            if not requirements_df.empty:
+                st.subheader("📦 المواد الخام المطلوبة (تبدأ بـ 1)")
+                _show_page(requirements_df, "requirements_page")
+            
+            # عرض جميع المستويات الـ BOM
+            if not all_levels_df.empty:
+                st.subheader("🏗️ جميع المواد في الـ BOM")
+                _show_page(all_levels_df, "all_levels_page")
+            
+            # عرض المواد الخام المنفصلة
+            if not raw_materials_df.empty:
+                st.subheader("📦 المواد الخام المفصلة (تبدأ بـ 1)")
+                _show_page(raw_materials_df, "raw_materials_page")
+            
+            # عرض الملخص الشهري
+            if not monthly_summary.empty:
+                st.subheader("📅 الملخص الشهري للكميات")
                 
-                # Calculate manufacturing quantities
-                self.calculate_manufacturing_quantities()
+                # عرض كجدول HTML منسق: الأعمدة تجهز مرة واحدة ثم تملأ قالب الصف SUMMARY_ROW_HTML بـ zip و join
+                # (أسرع من Styler الذي يحمل قالب jinja2 لجدول من بضعة صفوف)
+                summary_table = pd.DataFrame({
+                    'الشهر': monthly_summary['Month'],
+                    'E': monthly_summary.get('E', 0),
+                    'L': monthly_summary.get('L', 0),
+                    'الإجمالي': monthly_summary.get('الإجمالي', 0),
+                    'E%': monthly_summary.get('E%', ''),
+                    'L%': monthly_summary.get('L%', ''),
+                }).astype({'E': int, 'L': int, 'الإجمالي': int})
+                row_colors = ['#f2f2f2', '#ffffff'] * (len(summary_table) // 2 + 1)
+                table_rows = "".join(
+                    SUMMARY_ROW_HTML.format(*cells)
+                    for cells in zip(row_colors, *(summary_table[col].tolist() for col in summary_table.columns))
+                )
+                html_table = (
+                    "<table border='1' style='border-collapse: collapse; width:100%; text-align:center; color:black;'>"
+                    "<tr style='background-color:#d9d9d9; color:blue;'><th>الشهر</th><th>E</th><th>L</th><th>الإجمالي</th><th>E%</th><th>L%</th></tr>"
+                    f"{table_rows}</table>"
+                )
+                st.markdown(f"<div style='direction:rtl;'>{html_table}</div>", unsafe_allow_html=True)
                 
-                # Calculate requirements
-                if st.button("🚀 حساب متطلبات المواد", type="primary"):
-                    with st.spinner("جاري حساب متطلبات المواد..."):
-                        requirements_df = self.calculate_requirements()
-                        all_levels_df = self.calculate_all_levels_requirements()
-                        raw_materials_df = self.generate_raw_materials_sheet()
-                        monthly_summary = self.create_monthly_summary()
-                    
-                    # Display results
-                    st.header("📊 نتائج متطلبات المواد")
-                    
-                    # إحصائيات سريعة
-                    col1, col2, col3, col4 = st.columns(4)
-                    with col1:
-                        total_materials = len(requirements_df)
-                        st.metric("المواد الخام", total_materials)
-                    with col2:
-                        total_req = requirements_df['Total_Required'].sum()
-                        st.metric("إجمالي المتطلبات", f"{total_req:,.0f}")
-                    with col3:
-                        kg_materials = (requirements_df['UoM'] == 'KG').sum()
-                        st.metric("المواد بالكيلوجرام", kg_materials)
-                    with col4:
-                        materials_with_mrp = (requirements_df['MRP_Contor'] != '').sum()
-                        st.metric("مواد ذات MRP Contor", f"{materials_with_mrp}/{total_materials}")
-                    
-                    # عرض المواد الخام فقط
-                    if not requirements_df.empty:
-                        st.subheader("📦 المواد الخام المطلوبة (تبدأ بـ 1)")
-                        st.dataframe(requirements_df, use_container_width=True)
-                    
-                    # عرض جميع المستويات الـ BOM
-                    if not all_levels_df.empty:
-                        st.subheader("🏗️ جميع المواد في الـ BOM")
-                        st.dataframe(all_levels_df, use_container_width=True)
-                    
-                    # عرض المواد الخام المنفصلة
-                    if not raw_materials_df.empty:
-                        st.subheader("📦 المواد الخام المفصلة (تبدأ بـ 1)")
-                        st.dataframe(raw_materials_df, use_container_width=True)
-                    
-                    # عرض الملخص الشهري
-                    if not monthly_summary.empty:
-                        st.subheader("📅 الملخص الشهري للكميات")
-                        
-                        # عرض كجدول HTML منسق
-                        html_table = "<table border='1' style='border-collapse: collapse; width:100%; text-align:center; color:black;'>"
-                        html_table += "<tr style='background-color:#d9d9d9; color:blue;'><th>الشهر</th><th>E</th><th>L</th><th>الإجمالي</th><th>E%</th><th>L%</th></tr>"
-
-                        for idx, row in monthly_summary.iterrows():
-                            bg_color = "#f2f2f2" if idx % 2 == 0 else "#ffffff"
-                            html_table += f"<tr style='background-color:{bg_color};'>"
-                            html_table += f"<td style='color:blue;'>{row['Month']}</td>"
-                            html_table += f"<td>{int(row.get('E',0))}</td>"
-                            html_table += f"<td>{int(row.get('L',0))}</td>"
-                            html_table += f"<td>{int(row.get('الإجمالي',0))}</td>"
-                            html_table += f"<td>{row.get('E%','')}</td>"
-                            html_table += f"<td>{row.get('L%','')}</td>"
-                            html_table += "</tr>"
-
-                        html_table += "</table>"
-                        st.markdown(f"<div style='direction:rtl;'>{html_table}</div>", unsafe_allow_html=True)
-                        
-                        # رسم بياني
-                        st.subheader("📊 رسم بياني للكميات الشهرية")
-                        numeric_cols = [c for c in monthly_summary.columns if c not in ["Month", "الإجمالي", "E%", "L%"]]
-                        monthly_summary[numeric_cols] = monthly_summary[numeric_cols].apply(pd.to_numeric, errors="coerce")
-                        
-                        fig = px.bar(
-                            monthly_summary,
-                            x="Month",
-                            y=numeric_cols,
-                            barmode="group",
-                            text_auto=True,
-                            title="توزيع الكميات حسب نوع الأمر",
-                            template="streamlit"
-                        )
-                        st.plotly_chart(fig, use_container_width=True)
-                    
-                    # تحميل النتائج
-                    self.download_results(requirements_df, all_levels_df, raw_materials_df, monthly_summary)
-                    
-            except Exception as e:
-                st.error(f"❌ حدث خطأ غير متوقع: {e}")
+                # رسم بياني: يبنى ويرسل للمتصفح فقط عند فتح القسم (on_change="rerun" يتيح قراءة .open)
+                chart_section = st.expander("📊 رسم بياني للكميات الشهرية", key="monthly_chart", on_change="rerun")
+                if chart_section.open:
+                    chart_section.plotly_chart(self.create_monthly_chart(), use_container_width=True)
+            
+            # تحميل النتائج
+            self.download_results(requirements_df, all_levels_df, raw_materials_df, monthly_summary)
+            if calculate_clicked:
+                st.balloons()
 
-    def download_results(self, requirements_df, all_levels_df, raw_materials_df, monthly_summary):
-        """Handle downloading results"""
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            self.plan_df.to_excel(writer, sheet_name="Plan", index=False)
-            #requirements_df.to_excel(writer, sheet_name="RawMaterial_Requirements", index=False)
-            if not raw_materials_df.empty:
-                raw_materials_df.to_excel(writer, sheet_name="Raw_Materials", index=False)
+    def build_results_workbook(self, requirements_df, all_levels_df, raw_materials_df, monthly_summary) -> bytes:
+        """Build the results Excel workbook and return its bytes"""
+        # الملف الناتج يكتب في ملف مؤقت ينتقل للقرص إذا تجاوز 50MB، فتبقى في الذاكرة نسخة bytes واحدة فقط عند القراءة
+        # xlsxwriter في وضع constant_memory: كل صف يكتب للملف المؤقت بمجرد الانتقال للصف التالي
+        # فالذاكرة لا تكبر مع عدد الصفوف (الشيتات تكتب صفاً بصف عبر _write_sheet)
+        # strings_to_urls=False: النصوص تكتب كما هي بدون فحص كل خلية كرابط
+        options = {
+            'constant_memory': True,
+            'strings_to_urls': False,
+            'default_date_format': 'YYYY-MM-DD HH:MM:SS',
+        }
+        with tempfile.SpooledTemporaryFile(max_size=50_000_000) as output:
+            with xlsxwriter.Workbook(output, options) as workbook:
+                _write_sheet(workbook, "Plan", self.plan_df)
+                #_write_sheet(workbook, "RawMaterial_Requirements", requirements_df)
+                if not raw_materials_df.empty:
+                    _write_sheet(workbook, "Raw_Materials", raw_materials_df)
 
-            # إضافة شيت كميات التصنيع
-            if self.manufacturing_quantities:
-                manuf_df = pd.DataFrame([
-                    {
-                        'Material': mat,
-                        'Description': self.get_material_description(mat),
-                        'Material_Type': self.get_material_type(mat),
-                        'Level': self.get_material_level(mat),
-                        'Manufacturing_Quantity': qty,
-                        'MRP_Contor': self.get_mrp_control_value(mat)
-                    }
-                    for mat, qty in self.manufacturing_quantities.items()
-                ])
-                manuf_df.to_excel(writer, sheet_name="Manufacturing_Quantities", index=False)
-
-            # إضافة الشيتات الجديدة
-         #   if not all_levels_df.empty:
-          #      all_levels_df.to_excel(writer, sheet_name="All_Materials", index=False)
-            if not monthly_summary.empty:
-                monthly_summary.to_excel(writer, sheet_name="Monthly_Summary", index=False)
+                # إضافة شيت كميات التصنيع
+                if self.manufacturing_quantities:
+                    _write_sheet(workbook, "Manufacturing_Quantities", self._manufacturing_df)
 
-            self.bom_df.to_excel(writer, sheet_name="BOM", index=False)
-            if self.mrp_control_df is not None:
-                self.mrp_control_df.to_excel(writer, sheet_name="MRP_Contor", index=False)
+                # إضافة الشيتات الجديدة
+             #   if not all_levels_df.empty:
+              #      _write_sheet(workbook, "All_Materials", all_levels_df)
+                if not monthly_summary.empty:
+                    _write_sheet(workbook, "Monthly_Summary", monthly_summary)
 
-        
-        output.seek(0)
-        
+                _write_sheet(workbook, "BOM", self.bom_df)
+                if self.mrp_control_df is not None:
+                    _write_sheet(workbook, "MRP_Contor", self.mrp_control_df)
+
+            output.seek(0)
+            return output.read()
+
+    def download_results(self, requirements_df, all_levels_df, raw_materials_df, monthly_summary):
+        """Handle downloading results"""
+        # الملف ينشأ عند الضغط على زر التحميل فقط ولا يحتفظ به في الذاكرة بين إعادة التشغيل
         st.download_button(
             label="📥 تحميل النتائج كملف Excel",
-            data=output,
+            data=lambda: self.build_results_workbook(requirements_df, all_levels_df, raw_materials_df, monthly_summary),
+            on_click="ignore",
             file_name=f"MRP_Results_{pd.Timestamp.now().strftime('%Y%m%d_%H%M')}.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             type="primary"
         )
-        st.balloons()
+
+@st.cache_resource(show_spinner="جاري تحضير البيانات...", max_entries=4)
+def get_calculator(file_bytes: bytes):
+    """حاسبة محضرة لكل ملف مرفوع تبقى عبر إعادة تشغيل Streamlit (None عند فشل التحضير)"""
+    calculator = MRPCalculator()
+    if not calculator.prepare(io.BytesIO(file_bytes)):
+        return None
+    return calculator
+
+
+def run():
+    """Main execution method"""
+    # File upload section
+    st.header("📁 رفع ملف الخطة")
+    
+    uploaded_file = st.file_uploader(
+        "اختر ملف Excel الذي يحتوي على شيت Plan وBOM (واختياري: MRP Contor)",
+        type=["xlsx", "xls"],
+        help="يجب أن يحتوي الملف على شيتين: 'Plan' و 'BOM' - واختياري: 'MRP Contor'",
+        on_change=_set_calculated, args=(False,)
+    )
+    
+    if uploaded_file is not None:
+        try:
+            # تحميل البيانات وبناء علاقات الـ BOM (مرة واحدة لكل ملف عبر إعادة التشغيل)
+            file_bytes = uploaded_file.getvalue()
+            calculator = get_calculator(file_bytes)
+            if calculator is None:
+                # لا يحتفظ بنتيجة الفشل في الكاش، فإعادة رفع نفس الملف تعيد المحاولة
+                get_calculator.clear(file_bytes)
+                return
+            
+            with calculator.session():
+                calculator.show_analysis()
+                
+        except Exception as e:
+            st.error(f"❌ حدث خطأ غير متوقع: {e}")
 
 # Run the application
 if __name__ == "__main__":
-    calculator = MRPCalculator()
-    calculator.run()
+    run()
 
 # --- التذييل ---
 st.markdown(